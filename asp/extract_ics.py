@@ -7,26 +7,65 @@
 
 import json
 import sys
+from datetime import date, datetime, time, timezone
 from pathlib import Path
 
 import icalendar
 import recurring_ical_events
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(obj: object):
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def format_dt(dt: date):
+    # Serialize directly rather than round-tripping through to_ical().
+    if not isinstance(dt, datetime):
+        return dt.strftime("%Y%m%d")
+    if dt.tzinfo is None:
+        return dt.strftime("%Y%m%dT%H%M%S")
+    return dt.astimezone(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+
+def starts_before(dt: date, stop: date):
+    # Compare a date stop as midnight in dt's timezone, as recurring_ical_events
+    # does when mixing dates and datetimes.
+    if not isinstance(dt, datetime):
+        return dt < stop
+    return dt < datetime.combine(stop, time(), dt.tzinfo)
+
 
 def parse_event(event: icalendar.Component):
     return {
         "title": event["SUMMARY"],
         "description": event["DESCRIPTION"],
-        "startAt": event["DTSTART"].to_ical().decode("ascii"),
-        "endAt": event["DTEND"].to_ical().decode("ascii"),
+        "startAt": format_dt(event["DTSTART"].dt),
+        "endAt": format_dt(event["DTEND"].dt),
     }
 
 
 if __name__ == "__main__":
     _, ics_file = sys.argv
-    cal = icalendar.Calendar.from_ical(Path(ics_file).read_text())
-    data = {"name": cal["X-WR-CALNAME"], "events": []}
-    for event in recurring_ical_events.of(cal).at(2025):
-        data["events"].append(parse_event(event))
-    json.dump(data, sys.stdout, indent=2)
-    print()
+    cal = icalendar.Calendar.from_ical(Path(ics_file).read_bytes())
+    # after() lazily yields occurrences in start order (unlike between(), which
+    # returns a list), so each event is written out as soon as it is expanded.
+    # Start from a datetime: with a date, after() stops advancing once its search
+    # window shrinks below a day and an all-day event covers that day.
+    # If parse_event raises partway, stdout is left with a truncated document;
+    # the nonzero exit fails the step and .DELETE_ON_ERROR removes asp.json.
+    out = sys.stdout.buffer
+    out.write(b'{"name":' + dumps(cal["X-WR-CALNAME"]) + b',"events":[')
+    sep = b"\n"
+    for event in recurring_ical_events.of(cal).after(datetime(2025, 1, 1)):
+        if not starts_before(event["DTSTART"].dt, date(2026, 1, 1)):
+            break
+        out.write(sep + dumps(parse_event(event)))
+        sep = b",\n"
+    out.write(b"\n]}\n")
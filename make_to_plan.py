@@ -3,6 +3,12 @@ import sys
 from collections.abc import Iterable
 from dataclasses import dataclass
 
+_COMMENT = re.compile(r"#.*")
+_ASSIGN = re.compile(r"^(\S+) = (.*)\n$")
+# Only innermost references, so $(X) inside $(dir $(X)) is still substituted.
+_VAR = re.compile(r"\$[<^@]|\$\([^()$]+\)")
+_SUBMAKE = re.compile(r"^\$\(MAKE\) -C (\S+) (.+)")
+
 
 @dataclass
 class Rule:
@@ -11,29 +17,47 @@ class Rule:
     recipe: list[str]
 
 
+def expand(s: str, subs: dict[str, str], bindings: dict[str, str]):
+    def repl(match: re.Match[str]):
+        token = match[0]
+        if token in subs:
+            return subs[token]
+        # Leave unbound variables like $(MAKE) untouched.
+        return bindings.get(token, token)
+
+    # Repeat so binding values that reference other bindings are expanded too.
+    # Without a cycle, each binding adds at most one level of nesting, plus one
+    # final pass that changes nothing.
+    for _ in range(len(bindings) + 2):
+        expanded = _VAR.sub(repl, s)
+        if expanded == s:
+            return s
+        s = expanded
+    raise Exception("recursive variable", s)
+
+
 def parse_rules(fh: Iterable[str]):
     rule: Rule | None = None
     rules: dict[str, Rule] = {}
+    # Keyed by the full "$(NAME)" token as it appears in recipes.
     bindings: dict[str, str] = {}
 
     for line in fh:
         # Skip comments and blank lines.
-        if not re.sub(r"#.*", "", line).strip():
+        if not _COMMENT.sub("", line).strip():
             continue
 
         if line.startswith("\t"):
             assert rule is not None
-            replaced = (
-                line.strip()
-                .replace("$<", rule.dependencies[0] if rule.dependencies else "")
-                .replace("$^", " ".join(rule.dependencies))
-                .replace("$@", rule.target)
-            )
-            for name, value in bindings.items():
-                replaced = replaced.replace(f"$({name})", value)
-            rule.recipe.append(replaced)
-        elif match := re.match(r"^(\S+) = (.*)\n$", line):
-            bindings[match[1]] = match[2]
+            subs = {
+                "$<": rule.dependencies[0] if rule.dependencies else "",
+                "$^": " ".join(rule.dependencies),
+                "$@": rule.target,
+            }
+
+            rule.recipe.append(expand(line.strip(), subs, bindings))
+        elif match := _ASSIGN.match(line):
+            bindings[f"$({match[1]})"] = match[2]
         else:
             target, dependencies = [x.strip() for x in line.split(":")]
             dependencies = dependencies.split()
@@ -52,75 +76,90 @@ def ident(s: str):
     return "rule@" + s.replace("/", "@_")
 
 
-def dfs(rule: Rule, rules: dict[str, Rule], visited: set[str]):
-    if rule.target in visited:
-        return
-    visited.add(rule.target)
-
-    for dep in rule.dependencies:
-        if dep in rules:
-            dfs(rules[dep], rules, visited)
-
+def emit_rule(rule: Rule, rules: dict[str, Rule], out: list[str]):
     prefix = f"step {ident(rule.target)}"
     if not rule.recipe and len(rule.dependencies) == 1:
-        print(f"{prefix}: identity")
+        out.append(f"{prefix}: identity")
         # knit can copy a subdirectory but not all outputs.
-        print(f"    result/ = {ident(rule.dependencies[0])}:result/")
+        out.append(f"    result/ = {ident(rule.dependencies[0])}:result/")
     elif len(rule.recipe) == 1:
-        if match := re.match(r"^\$\(MAKE\) -C (\S+) (.+)", rule.recipe[0]):
+        if match := _SUBMAKE.match(rule.recipe[0]):
             subdir, target = match[1], match[2]
-            print(f'{prefix}@plan: cmd "sh" "in/plan.sh"')
-            print(
+            out.append(f'{prefix}@plan: cmd "sh" "in/plan.sh"')
+            out.append(
                 '    plan.sh = "exec python3 in/make_to_plan.py in/Makefile $target > out/plan.knit"'
             )
-            print(f"    Makefile = ./{subdir}/Makefile")
-            print(f'    $target = "{target}"')
-            print("    make_to_plan.py = ./make_to_plan.py")
+            out.append(f"    Makefile = ./{subdir}/Makefile")
+            out.append(f'    $target = "{target}"')
+            out.append("    make_to_plan.py = ./make_to_plan.py")
 
-            print(
+            out.append(
                 f"{prefix}@flow: flow ./{subdir}/ {ident(rule.target)}@plan:plan.knit"
             )
             if rule.dependencies:
                 assert len(rule.dependencies) == 1
                 assert rule.dependencies[0] == f"{subdir}/_params/"
                 for dep in rules[rule.dependencies[0]].dependencies:
-                    print(f"    {dep} = {ident(dep)}:result/{dep}")
+                    out.append(f"    {dep} = {ident(dep)}:result/{dep}")
 
-            print(f"{prefix}: identity")
-            print(f"    result/{subdir}/ = {ident(rule.target)}@flow:result/")
+            out.append(f"{prefix}: identity")
+            out.append(f"    result/{subdir}/ = {ident(rule.target)}@flow:result/")
         else:
-            print(f'{prefix}: cmd "sh" "-e" "in/run.sh"')
-            print(
+            out.append(f'{prefix}: cmd "sh" "-e" "in/run.sh"')
+            out.append(
                 '    run.sh = "cd in; mkdir -p $(dirname $_target); sh recipe; install -D $_target ../out/result/$_target"'
             )
-            print(f'    $_target = "{rule.target}"')
-            print(f'    recipe = "{q(rule.recipe[0])}"')
+            out.append(f'    $_target = "{rule.target}"')
+            out.append(f'    recipe = "{q(rule.recipe[0])}"')
             for dep in rule.dependencies:
                 if dep in rules:
-                    print(f"    {dep} = {ident(dep)}:result/{dep}")
+                    out.append(f"    {dep} = {ident(dep)}:result/{dep}")
                 elif dep.startswith("_params/"):
-                    print(f"    {dep} = _params:{dep.split('/', 1)[1]}")
+                    out.append(f"    {dep} = _params:{dep.split('/', 1)[1]}")
                 else:
-                    print(f"    {dep} = ./{dep}")
+                    out.append(f"    {dep} = ./{dep}")
     elif rule.target.endswith("/_params/"):
         pass
     else:
         raise Exception("unhandled rule", rule.target)
 
 
+def dfs(rule: Rule, rules: dict[str, Rule], visited: set[str], out: list[str]):
+    # Iterative post-order traversal; dependencies are pushed in reverse so they
+    # are emitted in the same order as a recursive walk.
+    stack = [(rule, False)]
+    while stack:
+        rule, processed = stack.pop()
+        if processed:
+            emit_rule(rule, rules, out)
+            continue
+        if rule.target in visited:
+            continue
+        visited.add(rule.target)
+
+        stack.append((rule, True))
+        for dep in reversed(rule.dependencies):
+            if dep in rules:
+                stack.append((rules[dep], False))
+
+
 def main():
     _, filename, target = sys.argv
 
     with open(filename) as fh:
         rules = parse_rules(fh)
 
-    print("step _params: params")
+    out: list[str] = []
+    out.append("step _params: params")
     for rule in rules.values():
         for dep in rule.dependencies:
             if dep.startswith("_params/"):
-                print(f"    {dep.split('/', 1)[1]} = !")
+                out.append(f"    {dep.split('/', 1)[1]} = !")
+
+    dfs(rules[target], rules, set(), out)
 
-    dfs(rules[target], rules, set())
+    sys.stdout.write("\n".join(out))
+    sys.stdout.write("\n")
 
 
 if __name__ == "__main__":
@@ -36,13 +36,16 @@ function formatBriefTime(time: Temporal.PlainTime) {
   return s;
 }
 
+const HTML_ESCAPES: Record<string, string> = {
+  "&": "&amp;",
+  "<": "&lt;",
+  ">": "&gt;",
+  '"': "&quot;",
+  "'": "&apos;",
+};
+
 function escapeHtml(s: string) {
-  return s
-    .replaceAll("&", "&amp;")
-    .replaceAll("<", "&lt;")
-    .replaceAll(">", "&gt;")
-    .replaceAll('"', "&quot;")
-    .replaceAll("'", "&apos;");
+  return s.replace(/[&<>"']/g, (c) => HTML_ESCAPES[c]);
 }
 
 abstract class Event {